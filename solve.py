@@ -1,58 +1,93 @@
+import heapq
+from array import array
+from itertools import count
 from math import inf
-from typing import Dict, Union, TypeVar, Generic
-from math import inf as infinity
-import sortedcontainers  # type: ignore
+from typing import Dict, Union
 
-from vexed import Level
-
-# introduce generic type
-T = TypeVar("T")
+from vexed import Level, Move
 
 
 ################################################################################
-class SearchNode(Generic[T]):
-    """Representation of a search node"""
-
-    __slots__ = ("data", "hash", "gscore", "fscore", "came_from", "in_openset")
+class SearchNodes:
+    """Search nodes stored as parallel arrays indexed by node id.
+
+    Node ids are handed out in discovery order; `ids` maps a state hash to its
+    node id. Keeping the scalars in arrays avoids allocating an object (and
+    boxed floats) per discovered state.
+    """
+
+    __slots__ = (
+        "ids",
+        "data",
+        "gscore",
+        "fscore",
+        "came_from",
+        "move_from_parent",
+        "closed",
+    )
 
-    def __init__(
-        self, data: T, gscore: float = infinity, fscore: float = infinity
-    ) -> None:
-        self.data = data
-        self.hash = hash(data)
-        self.gscore = gscore
-        self.fscore = fscore
-        self.in_openset = False
-        self.came_from: Union[None, int] = None
+    def __init__(self) -> None:
+        self.ids: Dict[int, int] = dict()
+        self.data: list[Union[None, Level]] = []
+        self.gscore = array("d")
+        self.fscore = array("d")
+        self.came_from = array("q")
+        self.move_from_parent: list[Union[None, Move]] = []
+        self.closed = bytearray()
+
+    def add(self, data: Level) -> int:
+        node = len(self.data)
+        self.ids[hash(data)] = node
+        self.data.append(data)
+        self.gscore.append(inf)
+        self.fscore.append(inf)
+        self.came_from.append(-1)
+        self.move_from_parent.append(None)
+        self.closed.append(False)
+        return node
+
+    def close(self, node: int) -> None:
+        """Mark the node as expanded, releasing its data to save memory"""
+        self.closed[node] = True
+        # a cached children dict would keep the whole expanded tree alive
+        self.data[node].clear_cache()
+        self.data[node] = None
+
+    def path(self, node: int) -> list[Move]:
+        moves = []
+        while self.came_from[node] != -1:
+            moves.append(self.move_from_parent[node])
+            node = self.came_from[node]
+        moves.reverse()
+        return moves
 
-    def __lt__(self, b: "SearchNode[T]") -> bool:
-        """Natural order is based on the fscore value & is used by heapq operations"""
-        return self.fscore < b.fscore
+    def __len__(self) -> int:
+        return len(self.data)
 
 
 ################################################################################
-SNType = TypeVar("SNType", bound=SearchNode)
+class OpenSet:
+    """Binary heap of node ids with lazy deletion.
 
+    Re-pushing a node whose fscore improved leaves its old entry in the heap;
+    callers discard popped entries whose fscore is stale or whose node has
+    already been closed.
+    """
 
-class OpenSet(Generic[SNType]):
     def __init__(self) -> None:
-        self.sortedlist = sortedcontainers.SortedList(key=lambda x: x.fscore)
-
-    def push(self, item: SNType) -> None:
-        item.in_openset = True
-        self.sortedlist.add(item)
+        self._heap: list[tuple[float, int, int]] = []
+        self._counter = count()
 
-    def pop(self) -> SNType:
-        item = self.sortedlist.pop(0)
-        item.in_openset = False
-        return item
+    def push(self, node: int, fscore: float) -> None:
+        # the counter breaks fscore ties in insertion order
+        heapq.heappush(self._heap, (fscore, next(self._counter), node))
 
-    def remove(self, item: SNType) -> None:
-        self.sortedlist.remove(item)
-        item.in_openset = False
+    def pop(self) -> tuple[float, int]:
+        fscore, _, node = heapq.heappop(self._heap)
+        return fscore, node
 
     def __len__(self) -> int:
-        return len(self.sortedlist)
+        return len(self._heap)
 
 
 class VexedSolver:
@@ -67,57 +102,42 @@ class VexedSolver:
         if start.is_win():
             return [start]
 
-        openSet: OpenSet[SearchNode[Level]] = OpenSet()
-        searchNodes: Dict[int, SearchNode[T]] = dict()
-        startNode = searchNodes[start] = SearchNode(
-            start, gscore=0.0, fscore=start.heuristics
-        )
-        openSet.push(startNode)
+        openSet = OpenSet()
+        searchNodes = SearchNodes()
+        gscores = searchNodes.gscore
+        fscores = searchNodes.fscore
+        closed = searchNodes.closed
+        startNode = searchNodes.add(start)
+        gscores[startNode] = 0.0
+        fscores[startNode] = start.heuristics
+        openSet.push(startNode, fscores[startNode])
 
         previous_f_score = 0
         while openSet:
-            current = openSet.pop()
+            fscore, current = openSet.pop()
+            if closed[current] or fscore != fscores[current]:
+                continue
+            current_data = searchNodes.data[current]
 
-            if current.data.is_win():
+            if current_data.is_win():
                 print(len(searchNodes), "\n")
-                result = []
-                while current.came_from is not None:
-                    result.append(current.hash)
-                    for sn in searchNodes.values():
-                        if sn.hash == current.came_from:
-                            current = sn
-                            break
-
-                moves = []
-                level: Level = start
-                while result:
-                    h = result.pop()
-                    for move, child in level.children().items():
-                        if hash(child) == h:
-                            moves.append(move)
-                            level = child
-                            break
-                return moves
+                return self._recolor(start, searchNodes.path(current))
 
             if (
                 self.maximal_cost is not None
-                and current.data.heuristics > self.maximal_cost
+                and current_data.heuristics > self.maximal_cost
             ):
-                del current.data
-                del current.came_from
+                searchNodes.close(current)
                 continue
 
-            for n in current.data.children().values():
-                h = hash(n)
-                if h not in searchNodes:
-                    neighbor = SearchNode(n)
-                    searchNodes[h] = neighbor
-                    if current.fscore > previous_f_score:
-                        previous_f_score = current.fscore
+            for move, n in current_data.children().items():
+                neighbor = searchNodes.ids.get(hash(n))
+                if neighbor is None:
+                    neighbor = searchNodes.add(n)
+                    if fscore > previous_f_score:
+                        previous_f_score = fscore
                         closed_nodes = tuple(
-                            sn.gscore
-                            for sn in searchNodes.values()
-                            if not hasattr(sn, "data")
+                            g for g, c in zip(gscores, closed) if c
                         )
                         print(
                             len(searchNodes),
@@ -127,31 +147,100 @@ class VexedSolver:
                                 if len(closed_nodes) > 0
                                 else 0
                             ),
-                            current.fscore,
+                            fscore,
                         )
-                else:
-                    neighbor = searchNodes[h]
-                    if not hasattr(neighbor, "data"):
-                        continue
+                elif closed[neighbor]:
+                    continue
 
-                tentative_gscore = current.gscore + 1
+                tentative_gscore = gscores[current] + 1
 
-                if tentative_gscore >= neighbor.gscore:
+                if tentative_gscore >= gscores[neighbor]:
                     continue
 
-                if neighbor.in_openset:
-                    openSet.remove(neighbor)
-
                 # update the node
-                neighbor.came_from = current.hash
-                neighbor.gscore = tentative_gscore
-                neighbor.fscore = tentative_gscore + neighbor.data.heuristics
-
-                openSet.push(neighbor)
-            del current.data
+                searchNodes.came_from[neighbor] = current
+                searchNodes.move_from_parent[neighbor] = move
+                gscores[neighbor] = tentative_gscore
+                fscores[neighbor] = (
+                    tentative_gscore + searchNodes.data[neighbor].heuristics
+                )
+
+                openSet.push(neighbor, fscores[neighbor])
+            searchNodes.close(current)
         print(len(searchNodes), "\n")
         return None
 
+    @staticmethod
+    def _recolor(start: Level, moves: list[Move]) -> list[Move]:
+        """Give each move the color it has when replayed from `start`.
+
+        States that only differ by a color swap share one search node, so a
+        recorded move may use the color numbering of such a twin.
+        """
+        level = start
+        recolored = []
+        for move in moves:
+            move = move._replace(color=level.color_at(move.row, move.col))
+            recolored.append(move)
+            level = level.move(move)
+        return recolored
+
+    def idastar(self, start: Level, maximal_cost: float = inf):
+        """Iterative deepening A*.
+
+        Memory is the current path plus, for the running iteration, the
+        smallest gscore at which each state has been reached.
+        """
+        if maximal_cost is not None and maximal_cost != inf:
+            self.maximal_cost = maximal_cost
+        if start.is_win():
+            return []
+
+        path: list[Move] = []
+
+        def search(level: Level, gscore: int) -> bool:
+            nonlocal next_threshold
+            try:
+                for move, child in level.children().items():
+                    h = hash(child)
+                    # a state already reached as cheaply in this iteration,
+                    # through another move order or a cycle, is or has been
+                    # searched with at least as much budget
+                    if gscore + 1 >= seen.get(h, inf):
+                        continue
+                    seen[h] = gscore + 1
+                    if (
+                        self.maximal_cost is not None
+                        and child.heuristics > self.maximal_cost
+                    ):
+                        continue
+                    if child.is_win():
+                        path.append(move)
+                        return True
+                    fscore = gscore + 1 + child.heuristics
+                    if fscore > threshold:
+                        next_threshold = min(next_threshold, fscore)
+                        continue
+                    path.append(move)
+                    if search(child, gscore + 1):
+                        return True
+                    path.pop()
+                return False
+            finally:
+                # the cached children would otherwise keep the whole searched
+                # tree alive through the levels on the path
+                level.clear_cache()
+
+        threshold = start.heuristics
+        while threshold != inf:
+            print(threshold)
+            next_threshold = inf
+            seen: dict[int, int] = {hash(start): 0}
+            if search(start, 0):
+                return self._recolor(start, path)
+            threshold = next_threshold
+        return None
+
 
 if __name__ == "__main__":
     # level_str = ".hf...e./.eab..fh/.XXX..XX/.Xc....X/..b.a.c."
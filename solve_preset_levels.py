@@ -1,5 +1,6 @@
 import csv
 import os
+from multiprocessing import Pool
 from solve import VexedSolver
 from vexed import Level
 
@@ -9,37 +10,45 @@ solution_folder = "solutions"
 
 level_fn = "classic_ii_levels.txt"
 
-level_file = os.path.join(level_folder, level_fn)
-solution_fn = level_fn.split(".")[0] + ".csv"
-solution_file = os.path.join(solution_folder, solution_fn)
-with (
-    open(level_file, "r", encoding="latin-1") as f_level,
-    open(solution_file, "w", encoding="latin-1") as f_sol,
-):
-    solution_writer = csv.writer(f_sol)
-    for line in f_level.readlines():
-        name, level_str, target_moves = line.split(";")
-        target_moves = int(target_moves)
-        level = Level.from_str(level_str)
-        print(level, "\n")
-        solver = VexedSolver(level)
-        solution = solver.astar(level, target_moves)
-        if solution is None:
-            solution_writer.writerow(
-                [
-                    name,
-                    target_moves,
-                    -1,
-                    "No solution",
-                ]
-            )
-            continue
-        solution_writer.writerow(
-            [
-                name,
-                target_moves,
-                len(solution),
-                "|".join(str(move) for move in solution),
-            ]
-        )
-        f_sol.flush()
+
+def solve_level(task: tuple[str, str, int]) -> list:
+    name, level_str, target_moves = task
+    level = Level.from_str(level_str)
+    print(level, "\n")
+    solver = VexedSolver(level)
+    solution = solver.astar(level, target_moves)
+    if solution is None:
+        return [
+            name,
+            target_moves,
+            -1,
+            "No solution",
+        ]
+    return [
+        name,
+        target_moves,
+        len(solution),
+        "|".join(str(move) for move in solution),
+    ]
+
+
+if __name__ == "__main__":
+    level_file = os.path.join(level_folder, level_fn)
+    solution_fn = level_fn.split(".")[0] + ".csv"
+    solution_file = os.path.join(solution_folder, solution_fn)
+    with open(level_file, "r", encoding="latin-1") as f_level:
+        tasks = []
+        for line in f_level.readlines():
+            name, level_str, target_moves = line.split(";")
+            tasks.append((name, level_str, int(target_moves)))
+
+    # levels are independent, so solve them in parallel and write each row
+    # as soon as it is ready; solve times vary a lot between levels
+    with (
+        open(solution_file, "w", encoding="latin-1") as f_sol,
+        Pool(os.cpu_count()) as pool,
+    ):
+        solution_writer = csv.writer(f_sol)
+        for row in pool.imap_unordered(solve_level, tasks, chunksize=1):
+            solution_writer.writerow(row)
+            f_sol.flush()
@@ -1,51 +1,67 @@
 from __future__ import annotations
-from copy import deepcopy
-from dataclasses import dataclass
-from collections import defaultdict
+from concurrent.futures import Executor
 from functools import lru_cache
+from typing import NamedTuple
 from math import inf
 
 
 class Walls:
-    __slots__ = ("walls", "width", "height", "empty_columns", "cells_min_dists")
+    __slots__ = (
+        "walls",
+        "width",
+        "height",
+        "board_mask",
+        "walls_mask",
+        "not_left_edge",
+        "not_right_edge",
+        "reachable",
+        "reachable_around",
+        "background",
+    )
 
     def __init__(self, walls: tuple[tuple[bool]]):
         self.walls = walls
         self.width = len(self.walls[0])
         self.height = len(self.walls)
-        self.empty_columns: list[tuple[int, int, int]] = []
-        for col in range(self.width):
-            empty_col_row_start: int = None
-            for row in range(self.height + 1):
-                is_wall = self.is_wall(row, col)
-                if is_wall == (empty_col_row_start is None):
-                    continue
+        # cell (row, col) is stored in bit row * width + col of a bitboard
+        self.board_mask = (1 << (self.width * self.height)) - 1
+        self.walls_mask = 0
+        for row, row_walls in enumerate(self.walls):
+            for col, is_wall in enumerate(row_walls):
                 if is_wall:
-                    self.empty_columns.append((col, empty_col_row_start, row))
-                    empty_col_row_start = None
-                else:
-                    empty_col_row_start = row
-        self.cells_min_dists: dict[int, dict[int, int]] = {}
-        # (self_col_idx, self_height), (other_col_idx, other_height)
-        
-        blocks = tuple(
-            (idx, row, empty_col[0])
-            for idx, empty_col in enumerate(self.empty_columns)
-            for row in range(empty_col[1], empty_col[2])
-        )
-
-        for idx_1, b1 in enumerate(blocks):
-            _d = {}
-            for idx_2, b2 in enumerate(blocks):
-                if b1[0] == b2[0]:
-                    _d[idx_2] = 0
-                else:
-                    _d[idx_2] = inf
-            self.cells_min_dists[idx_1] = _d
-
-        updated = True
-        current_distance = 0
-        
+                    self.walls_mask |= self.cell_bit(row, col)
+        left_edge = sum(1 << (row * self.width) for row in range(self.height))
+        self.not_left_edge = self.board_mask & ~left_edge
+        self.not_right_edge = self.board_mask & ~(left_edge << (self.width - 1))
+        # for each cell, the cells a block starting there could ever occupy
+        # (it slides along its row and falls, but never rises) and the cells
+        # next to those; other blocks are ignored, so this over-approximates
+        free = self.board_mask & ~self.walls_mask
+        self.reachable: list[int] = []
+        self.reachable_around: list[int] = []
+        for index in range(self.width * self.height):
+            region = (1 << index) & free
+            while True:
+                grown = region | free & (
+                    ((region << 1) & self.not_left_edge)
+                    | ((region >> 1) & self.not_right_edge)
+                    | (region << self.width)
+                )
+                if grown == region:
+                    break
+                region = grown
+            self.reachable.append(region)
+            self.reachable_around.append(
+                region
+                | ((region << 1) & self.not_left_edge)
+                | ((region >> 1) & self.not_right_edge)
+                | ((region << self.width) & self.board_mask)
+                | (region >> self.width)
+            )
+        # Level.__repr__ of an empty board
+        self.background = "\n".join(
+            "".join("#" if is_wall else " " for is_wall in row) for row in self.walls
+        ).encode("latin-1")
 
     def __hash__(self):
         return hash(self.walls)
@@ -55,7 +71,10 @@ class Walls:
             return True
         if col < 0 or col >= self.width:
             return True
-        return self.walls[row][col]
+        return bool(self.walls_mask >> (row * self.width + col) & 1)
+
+    def cell_bit(self, row: int, col: int) -> int:
+        return 1 << (row * self.width + col)
 
     @staticmethod
     def from_str(s: str, wall_char: str = "X", new_line_char: str = "/") -> Walls:
@@ -65,8 +84,7 @@ class Walls:
         return Walls(walls=tuple(rows))
 
 
-@dataclass(frozen=True)
-class Move:
+class Move(NamedTuple):
     row: int
     col: int
     color: int
@@ -92,165 +110,283 @@ class Move:
         return (self.row, self.col + d_col)
 
 
-@lru_cache
-def color_heuristics(x_coords: tuple[int]):
-    if len(x_coords) == 2:
-        return max(x_coords[1] - x_coords[0] - 1, 0)
-    dists = tuple(
-        max(x_coords[i + 1] - x_coords[i] - 1, 0) for i in range(len(x_coords) - 1)
-    )
-    h = dists[0] + dists[-1]
-    for dist, next_dist in zip(dists[:-1], dists[1:]):
-        h += min(dist, next_dist)
-    return h
-
-
-def nested_tuple_to_nested_list(tuple_repr: tuple[tuple[int]]) -> list[list[int]]:
-    return [list(inner) for inner in tuple_repr]
-
-
-def nested_list_to_nested_tuple(list_repr: list[list[int]]) -> tuple[tuple[int]]:
-    return tuple(tuple(inner) for inner in list_repr)
-
-
 class Level:
-    __slots__ = ("walls", "tuple_repr", "heuristics")
+    __slots__ = (
+        "walls",
+        "bitboards",
+        "_hash",
+        "_heuristics_value",
+        "_moves",
+        "_children",
+    )
 
-    def __init__(self, walls: Walls, tuple_repr: tuple[tuple[int]]):
+    def __init__(self, walls: Walls, bitboards: tuple[int, ...]):
         self.walls = walls
-        self.tuple_repr = tuple_repr
-        self.heuristics: int = self._heuristics()
+        # bitboards[0] holds the walls, bitboards[c] the blocks of color c
+        self.bitboards = bitboards
+        self._hash = hash(self._key())
+        self._moves: list[Move] = None
+        self._children: dict[Move, Level] = None
+        self._heuristics_value: int = None
 
     def __repr__(self):
-        row_lists = [[] for _ in range(self.walls.height)]
-        for col in self.tuple_repr:
-            for i, cell in enumerate(col):
-                if cell == -1:
-                    row_lists[i].append("#")
-                elif cell == 0:
-                    row_lists[i].append(" ")
-                else:
-                    row_lists[i].append(chr(cell + 96))
-
-        return "\n".join("".join(row_list) for row_list in row_lists)
-
-    def _move(self, move: Move, list_repr: list[list[int]]) -> Level:
-        merge_settled = False
-        list_repr[move.col][move.row] = 0
-        list_repr[move.new_position()[1]][move.new_position()[0]] = move.color
-        while not merge_settled:
-            fall_settled = True
-            for x, row_start, row_end in self.walls.empty_columns:
-                for i in range(row_start, row_end - 1):
-                    for j in range(row_end - 2, i - 1, -1):
-                        if list_repr[x][j] == 0 or list_repr[x][j + 1] != 0:
-                            continue
-                        list_repr[x][j + 1] = list_repr[x][j]
-                        list_repr[x][j] = 0
-                        fall_settled = False
-
-            if fall_settled and merge_settled:
+        width = self.walls.width
+        chars = bytearray(self.walls.background)
+        for color in range(1, len(self.bitboards)):
+            bitboard = self.bitboards[color]
+            while bitboard:
+                lowest = bitboard & -bitboard
+                index = lowest.bit_length() - 1
+                # one newline precedes every row but the first
+                chars[index + index // width] = color + 96
+                bitboard ^= lowest
+        return chars.decode("latin-1")
+
+    def _move(self, move: Move, bitboards: list[int]) -> Level:
+        # the source and destination cells are adjacent bits of one row
+        moved = 3 << (move.row * self.walls.width + move.col - move.to_left)
+        bitboards[move.color] ^= moved
+        return self._settle(bitboards, moved)
+
+    def _settle(self, bitboards: list[int], moved: int) -> Level:
+        """Let blocks fall and merge until the board is stable.
+
+        Only blocks in the `moved` mask, or that fall, are checked for new
+        same-color neighbours.
+        """
+        walls = self.walls
+        width = walls.width
+        not_left_edge = walls.not_left_edge
+        not_right_edge = walls.not_right_edge
+        free = walls.board_mask & ~bitboards[0]
+        colors = [color for color in range(1, len(bitboards)) if bitboards[color]]
+        blocks = 0
+        for color in colors:
+            blocks |= bitboards[color]
+        while True:
+            # every block above a vacant cell drops by one row until none can
+            falling = blocks & ((free & ~blocks) >> width)
+            while falling:
+                for color in colors:
+                    color_falling = bitboards[color] & falling
+                    if color_falling:
+                        bitboards[color] ^= color_falling | (color_falling << width)
+                blocks ^= falling | (falling << width)
+                moved |= falling << width
+                falling = blocks & ((free & ~blocks) >> width)
+
+            to_be_merged = 0
+            for color in colors:
+                bitboard = bitboards[color]
+                if not bitboard & moved:
+                    continue
+                to_be_merged |= bitboard & (
+                    ((bitboard << 1) & not_left_edge)
+                    | ((bitboard >> 1) & not_right_edge)
+                    | (bitboard << width)
+                    | (bitboard >> width)
+                )
+
+            if to_be_merged == 0:
                 break
+            for color in colors:
+                bitboards[color] &= ~to_be_merged
+            blocks &= ~to_be_merged
+            colors = [color for color in colors if bitboards[color]]
+            moved = 0
 
-            to_be_merged: set[tuple[int, int]] = set()
-
-            for x in range(self.walls.width):
-                for y in range(self.walls.height):
-                    if list_repr[x][y] <= 0:
-                        continue
-                    if (
-                        y < self.walls.height - 1
-                        and list_repr[x][y] == list_repr[x][y + 1]
-                    ):
-                        to_be_merged.add((x, y))
-                        to_be_merged.add((x, y + 1))
-                    if (
-                        x < self.walls.width - 1
-                        and list_repr[x][y] == list_repr[x + 1][y]
-                    ):
-                        to_be_merged.add((x, y))
-                        to_be_merged.add((x + 1, y))
-
-            merge_settled = len(to_be_merged) == 0
-            for x, y in to_be_merged:
-                list_repr[x][y] = 0
-
-        return Level(self.walls, nested_list_to_nested_tuple(list_repr))
+        return Level(self.walls, tuple(bitboards))
 
     def move(self, move: Move) -> Level:
-        assert self.tuple_repr[move.col][move.row] == move.color
-        assert self.tuple_repr[move.new_position()[1]][move.new_position()[0]] == 0
-        list_repr = nested_tuple_to_nested_list(self.tuple_repr)
-        return self._move(move, list_repr)
+        occupied = 0
+        for bitboard in self.bitboards:
+            occupied |= bitboard
+        assert self.bitboards[move.color] & self.walls.cell_bit(
+            *move.original_position()
+        )
+        assert not occupied & self.walls.cell_bit(*move.new_position())
+        return self._move(move, list(self.bitboards))
 
     def possible_moves(self) -> list[Move]:
+        if self._moves is None:
+            self._moves = self._possible_moves()
+        return self._moves
+
+    def _possible_moves(self) -> list[Move]:
         moves: list[Move] = []
-        for x, col in enumerate(self.tuple_repr[:-1]):
-            for y, cell in enumerate(col):
-                right_cell = self.tuple_repr[x + 1][y]
-                if cell == 0 and right_cell >= 0:
-                    moves.append(Move(y, x + 1, right_cell, True))
-                elif right_cell == 0 and cell >= 0:
-                    moves.append(Move(y, x, cell, False))
+        walls = self.walls
+        width = walls.width
+        vacant = walls.board_mask
+        for bitboard in self.bitboards:
+            vacant &= ~bitboard
+        # blocks with a vacant cell on their right / left, without wrapping rows
+        right_vacant = (vacant >> 1) & walls.not_right_edge
+        left_vacant = (vacant << 1) & walls.not_left_edge
+        for color in range(1, len(self.bitboards)):
+            bitboard = self.bitboards[color]
+            movable = bitboard & right_vacant
+            while movable:
+                lowest = movable & -movable
+                row, col = divmod(lowest.bit_length() - 1, width)
+                moves.append(Move(row, col, color, False))
+                movable ^= lowest
+            movable = bitboard & left_vacant
+            while movable:
+                lowest = movable & -movable
+                row, col = divmod(lowest.bit_length() - 1, width)
+                moves.append(Move(row, col, color, True))
+                movable ^= lowest
         return moves
 
     def children(self) -> dict[Move, Level]:
-        list_repr = nested_tuple_to_nested_list(self.tuple_repr)
-        return {
-            move: self._move(move, deepcopy(list_repr))
+        if self._children is None:
+            self._children = {
+                move: self._move(move, list(self.bitboards))
+                for move in self.possible_moves()
+            }
+        return self._children
+
+    def children_parallel(self, executor: Executor) -> dict[Move, Level]:
+        """Like children(), but the moves are computed by an executor.
+
+        Meant for splitting a search at its root across a process pool; the
+        result is not cached. Jobs carry the wall layout rather than this
+        Level, so one pool can serve any number of levels.
+        """
+        futures = {
+            move: executor.submit(
+                _move_in_worker, self.walls.walls, self.bitboards, move
+            )
             for move in self.possible_moves()
         }
+        # rebuilt here so that all children share this level's walls
+        return {
+            move: Level(self.walls, future.result())
+            for move, future in futures.items()
+        }
 
-    def _heuristics(self) -> int:
-        blocks_by_color = defaultdict(list[tuple[int, int]])
-        for x, col in enumerate(self.tuple_repr):
-            for y, cell in enumerate(col):
-                if cell <= 0:
-                    continue
-                blocks_by_color[cell].append((x, y))
+    def clear_cache(self) -> None:
+        self._moves = None
+        self._children = None
+
+    @property
+    def heuristics(self) -> int:
+        # computed on demand: the solver discards most children as duplicates
+        if self._heuristics_value is None:
+            self._heuristics_value = self._heuristics()
+        return self._heuristics_value
 
-        if len(blocks_by_color) == 0:
+    def _heuristics(self) -> int:
+        walls = self.walls
+        width = walls.width
+        bottom_row = (walls.height - 1) * width
+        bottom_walls = walls.walls_mask >> bottom_row
+        if not any(self.bitboards[1:]):
             return 0
         h = 0
-        for bs in blocks_by_color.values():
-            n_blocks = len(bs)
+        for bitboard in self.bitboards[1:]:
+            if not bitboard:
+                continue
+            n_blocks = bitboard.bit_count()
             if n_blocks == 1:
                 return inf
             if n_blocks <= 3:
-                x_coords = [b[0] for b in bs if b[1] == self.walls.height - 1]
-                if len(x_coords) >= 2 and any(
-                    self.walls.walls[-1][x_coords[0] + 1 : x_coords[-1]]
+                bottom = bitboard >> bottom_row
+                # two blocks on the floor with a wall between them never meet
+                if bottom & (bottom - 1) and bottom_walls & (
+                    (1 << (bottom.bit_length() - 1))
+                    - (2 << ((bottom & -bottom).bit_length() - 1))
                 ):
                     return inf
-            h += color_heuristics(tuple(b[0] for b in bs))
+            x_coords = []
+            indices = []
+            while bitboard:
+                lowest = bitboard & -bitboard
+                index = lowest.bit_length() - 1
+                x_coords.append(index % width)
+                indices.append(index)
+                bitboard ^= lowest
+            # every block has to end up next to another block of its color
+            reachable = walls.reachable
+            for index in indices:
+                others = 0
+                for other in indices:
+                    if other != index:
+                        others |= reachable[other]
+                if not walls.reachable_around[index] & others:
+                    return inf
+            x_coords.sort()
+            gaps = [
+                max(x_coords[i + 1] - x_coords[i] - 1, 0) for i in range(n_blocks - 1)
+            ]
+            if n_blocks == 2:
+                h += gaps[0]
+                continue
+            h += gaps[0] + gaps[-1]
+            for gap, next_gap in zip(gaps[:-1], gaps[1:]):
+                h += min(gap, next_gap)
         return max(h, 1)
 
     def is_win(self):
         return self.heuristics == 0
 
     def __hash__(self):
-        return hash(self.tuple_repr)
+        return self._hash
 
     def __eq__(self, value: Level):
-        return hash(self) == hash(value)
+        if not isinstance(value, Level):
+            return NotImplemented
+        return self._hash == value._hash and self._key() == value._key()
+
+    def _key(self) -> tuple[int, ...]:
+        """Identity of the state, used by __hash__ and __eq__.
+
+        Colors are interchangeable, so the color boards are ordered by value
+        and cleared colors dropped: states that only differ by a color swap
+        share a key.
+        """
+        return (self.bitboards[0], *sorted(filter(None, self.bitboards[1:])))
+
+    def color_at(self, row: int, col: int) -> int:
+        bit = self.walls.cell_bit(row, col)
+        for color in range(1, len(self.bitboards)):
+            if self.bitboards[color] & bit:
+                return color
+        return 0
 
     @staticmethod
     def from_str(
         s: str, wall_char: str = "X", empty_char: str = ".", new_line_char="/"
     ) -> Level:
         walls = Walls.from_str(s, wall_char, new_line_char)
-        assigned_chars = []
-        cols = [[None for _ in range(walls.height)] for _ in range(walls.width)]
-        for i, row in enumerate(s.split(new_line_char)):
-            for j, char in enumerate(row):
-                if char == wall_char:
-                    cols[j][i] = -1
-                    continue
-                elif char == empty_char:
-                    cols[j][i] = 0
-                    continue
-                if char not in assigned_chars:
-                    assigned_chars.append(char)
-                cols[j][i] = assigned_chars.index(char) + 1
-
-        return Level(walls, nested_list_to_nested_tuple(cols))
+        board = s.replace(new_line_char, "")
+        # bit i of a bitboard is cell i in row-major order, so a color's
+        # bitboard is the reversed board read as binary with 1s for its cells
+        reversed_board = board[::-1]
+        others = {ord(char): "0" for char in set(board)}
+        bitboards = [walls.walls_mask]
+        # colors are numbered in order of first appearance
+        for char in dict.fromkeys(board):
+            if char == empty_char or char == wall_char:
+                continue
+            bitboards.append(
+                int(reversed_board.translate(others | {ord(char): "1"}), 2)
+            )
+
+        level = Level(walls, tuple(bitboards))
+        # the level as given may not be settled yet
+        return level._settle(bitboards, walls.board_mask)
+
+
+
+@lru_cache(maxsize=None)
+def _walls_for(walls: tuple[tuple[bool]]) -> Walls:
+    # built once per layout in each worker process
+    return Walls(walls)
+
+
+def _move_in_worker(
+    walls: tuple[tuple[bool]], bitboards: tuple[int, ...], move: Move
+) -> tuple[int, ...]:
+    level = Level(_walls_for(walls), bitboards)
+    return level._move(move, list(bitboards)).bitboards